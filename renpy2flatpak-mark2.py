@@ -4,20 +4,25 @@
 
 from __future__ import annotations
 import argparse
+import concurrent.futures
 import contextlib
 import hashlib
 import json
+import mmap
+import os
 import pathlib
 import shutil
 import subprocess
+import sys
 import tempfile
-import textwrap
+import threading
+import types
 import typing
-from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape
 
-try:
+if sys.version_info >= (3, 11):
     import tomllib
-except ImportError:
+else:
     import tomli as tomllib
 
 if typing.TYPE_CHECKING:
@@ -56,76 +61,204 @@ if typing.TYPE_CHECKING:
         workarounds: NotRequired[_Workarounds]
 
 
-def subelem(elem: ET.Element, tag: str, text: typing.Optional[str] = None, **extra: str) -> ET.Element:
-    new = ET.SubElement(elem, tag, extra)
-    new.text = text
-    return new
+_APPDATA_TEMPLATE = """\
+<?xml version='1.0' encoding='utf-8'?>
+<component type="desktop-application">
+  <id>{appid}</id>
+  <name>{name}</name>
+  <summary>{summary}</summary>
+  <metadata_license>CC0-1.0</metadata_license>
+  <project_license>{license}</project_license>
+  <recommends>
+    <control>pointing</control>
+    <control>keyboard</control>
+    <control>touch</control>
+    <control>gamepad</control>
+  </recommends>
+  <requires>
+    <display_length compare="ge">360</display_length>
+    <internet>offline-only</internet>
+  </requires>
+  <categories>
+{categories}  </categories>
+  <description>
+    <p>{summary}</p>
+  </description>
+  <launchable type="desktop-id">{appid}.desktop</launchable>
+{extra}</component>"""
+
+
+def _attrib(value: str) -> str:
+    # Same entities as ElementTree, a raw tab or newline would be normalized
+    # to a space by the parser
+    return escape(str(value), {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#09;'})
 
 
 def create_appdata(args: Arguments, workdir: pathlib.Path, appid: str) -> pathlib.Path:
     p = workdir / f'{appid}.metainfo.xml'
+    common = args.description['common']
+    appdata = args.description['appdata']
 
-    root =  ET.Element('component', type="desktop-application")
-    subelem(root, 'id', appid)
-    subelem(root, 'name', args.description['common']['name'])
-    subelem(root, 'summary', args.description['appdata']['summary'])
-    subelem(root, 'metadata_license', 'CC0-1.0')
-    subelem(root, 'project_license', args.description['appdata'].get('license', 'LicenseRef-Proprietary'))
+    categories = ''.join(
+        f'    <category>{escape(c)}</category>\n'
+        for c in ['Game'] + common['categories'])
 
-    recommends = ET.SubElement(root, 'recommends')
-    for c in ['pointing', 'keyboard', 'touch', 'gamepad']:
-        subelem(recommends, 'control', c)
-
-    requires = ET.SubElement(root, 'requires')
-    subelem(requires, 'display_length', '360', compare="ge")
-    subelem(requires, 'internet', 'offline-only')
-
-    categories = ET.SubElement(root, 'categories')
-    for c in ['Game'] + args.description['common']['categories']:
-        subelem(categories, 'category', c)
-
-    description = ET.SubElement(root, 'description')
-    subelem(description, 'p', args.description['appdata']['summary'])
-    subelem(root, 'launchable', f'{appid}.desktop', type="desktop-id")
+    extra: typing.List[str] = []
 
     # There is an oars-1.1, but it doesn't appear to be supported by KDE
     # discover yet
-    if 'content_rating' in args.description['appdata']:
-        cr = ET.SubElement(root, 'content_rating', type="oars-1.0")
-        for k, r in args.description['appdata']['content_rating'].items():
-            subelem(cr, 'content_attribute', r, id=k)
+    if 'content_rating' in appdata:
+        if appdata['content_rating']:
+            extra.append('  <content_rating type="oars-1.0">\n')
+            extra.extend(
+                f'    <content_attribute id="{_attrib(k)}">{escape(r)}</content_attribute>\n'
+                for k, r in appdata['content_rating'].items())
+            extra.append('  </content_rating>\n')
+        else:
+            extra.append('  <content_rating type="oars-1.0" />\n')
+
+    if 'releases' in appdata:
+        if appdata['releases']:
+            extra.append('  <releases>\n')
+            extra.extend(
+                f'    <release version="{_attrib(k)}" date="{_attrib(v)}" />\n'
+                for k, v in appdata['releases'].items())
+            extra.append('  </releases>\n')
+        else:
+            extra.append('  <releases />\n')
+
+    p.write_bytes(_APPDATA_TEMPLATE.format(
+        appid=escape(appid),
+        name=escape(common['name']),
+        summary=escape(appdata['summary']),
+        license=escape(appdata.get('license', 'LicenseRef-Proprietary')),
+        categories=categories,
+        extra=''.join(extra),
+    ).encode('utf-8'))
 
-    if 'releases' in args.description['appdata']:
-        cr = ET.SubElement(root, 'releases')
-        for k, v in args.description['appdata']['releases'].items():
-            subelem(cr, 'release', version=k, date=v)
+    return p
 
-    tree = ET.ElementTree(root)
-    ET.indent(tree)
-    tree.write(p, encoding='utf-8', xml_declaration=True)
 
-    return p
+_DESKTOP_TEMPLATE = """\
+[Desktop Entry]
+Name={name}
+Exec=game.sh
+Type=Application
+Categories=Game;{categories};
+"""
 
 
 def create_desktop(args: Arguments, workdir: pathlib.Path, appid: str) -> pathlib.Path:
     p = workdir / f'{appid}.desktop'
-    with p.open('w') as f:
-        f.write(textwrap.dedent(f'''\
-            [Desktop Entry]
-            Name={args.description['common']['name']}
-            Exec=game.sh
-            Type=Application
-            Categories=Game;{';'.join(args.description['common']['categories'])};
-            '''))
-        if args.description.get('workarounds', {}).get('icon', True):
-            f.write(f'Icon={appid}')
+    common = args.description['common']
+    want_icon = args.description.get('workarounds', {}).get('icon', True)
+    data = _DESKTOP_TEMPLATE.format(
+        name=common['name'],
+        categories=';'.join(common['categories']),
+    )
+    if want_icon:
+        data += f'Icon={appid}'
+    p.write_bytes(data.encode('utf-8'))
 
     return p
 
 
-def sha256(path: pathlib.Path) -> str:
-    with path.open('rb') as f:
-        return hashlib.sha256(f.read()).hexdigest()
+# (st_ino, st_size, st_mtime_ns, st_ctime_ns, digest)
+_HashEntry = typing.Tuple[int, int, int, int, str]
+
+_HASH_CACHE: typing.Optional[typing.Dict[str, _HashEntry]] = None
+_HASH_CACHE_LOCK = threading.Lock()
+_HASH_CACHE_UPDATES: typing.Dict[str, _HashEntry] = {}
+
+
+def _hash_cache_file() -> pathlib.Path:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return pathlib.Path(cache_home) / 'renpy2flatpak' / 'sha256.json'
+
+
+def _load_hash_cache() -> typing.Dict[str, _HashEntry]:
+    try:
+        with _hash_cache_file().open('rb') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    # The cache is only an optimization, ignore anything that doesn't look
+    # like an entry we wrote rather than failing the build
+    return {k: tuple(v) for k, v in data.items()
+            if isinstance(v, list) and len(v) == 5}
+
+
+def save_hash_cache() -> None:
+    """Write digests computed by sha256 since the last save to the cache."""
+    with _HASH_CACHE_LOCK:
+        if not _HASH_CACHE_UPDATES:
+            return
+        # Merge with what's on disk now, another build may have saved since
+        # this one loaded the cache
+        cache = _load_hash_cache()
+        cache.update(_HASH_CACHE_UPDATES)
+        _HASH_CACHE_UPDATES.clear()
+
+    cfile = _hash_cache_file()
+    try:
+        cfile.parent.mkdir(parents=True, exist_ok=True)
+        f = tempfile.NamedTemporaryFile('w', dir=cfile.parent, suffix='.tmp', delete=False)
+    except OSError:
+        # The cache is only an optimization, a read-only home is not fatal
+        return
+    try:
+        with f:
+            json.dump(cache, f)
+        os.replace(f.name, cfile)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(f.name)
+
+
+def _sha256(path: typing.Union[str, pathlib.Path]) -> str:
+    try:
+        # The digest is only passed on to flatpak-builder, this allows
+        # hashlib to use the OpenSSL implementation on FIPS enabled hosts
+        h = hashlib.new('sha256', usedforsecurity=False)
+    except TypeError:
+        # Python < 3.9
+        h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+        except (ValueError, OverflowError, OSError):
+            # Empty files can't be mapped, and on 32 bit systems the archive
+            # may not fit in the address space. Read in blocks instead, the
+            # archives can be several gigabytes in size
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def sha256(path: typing.Union[str, pathlib.Path]) -> str:
+    """Get the sha256 of a file, reusing the result from a previous run if
+    the file hasn't changed since.
+    """
+    global _HASH_CACHE
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    with _HASH_CACHE_LOCK:
+        if _HASH_CACHE is None:
+            _HASH_CACHE = _load_hash_cache()
+        cached = _HASH_CACHE.get(key)
+    # ctime is included because mtime can be set back with touch, which
+    # would otherwise give a stale digest for rewritten content
+    stamp = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+    if cached is not None and cached[:4] == stamp:
+        return cached[4]
+
+    digest = _sha256(path)
+    with _HASH_CACHE_LOCK:
+        _HASH_CACHE[key] = _HASH_CACHE_UPDATES[key] = (*stamp, digest)
+    return digest
 
 
 def sanitize_name(name: str) -> str:
@@ -135,58 +268,115 @@ def sanitize_name(name: str) -> str:
         .replace(':', '')
 
 
-def dump_json(args: Arguments, workdir: pathlib.Path, appid: str, desktop_file: pathlib.Path, appdata_file: pathlib.Path) -> None:
+_COMPILE_COMMAND = 'pushd /app/lib/game; ./*.sh . compile --keep-orphan-rpyc; popd'
+
+# The parts of the manifest that don't depend on the input. These are
+# immutable so they can be shared by every manifest, dump_json copies the dicts
+# since json can't serialize a MappingProxyType
+_GAME_BUILD_COMMANDS: typing.Tuple[str, ...] = (
+    'mkdir -p /app/lib/game',
+
+    # install the main game files
+    'mv *.sh *.py renpy game lib /app/lib/game/',
+
+    # Patch the game to not require sandbox access
+    '''sed -i 's@"~/.renpy/"@os.environ.get("XDG_DATA_HOME", "~/.local/share") + "/"@g' /app/lib/game/*.py''',
+
+    _COMPILE_COMMAND,
+)
+
+_GAME_CLEANUP: typing.Tuple[str, ...] = (
+    '*.exe',
+    '*.app',
+    '*.rpyc.bak',
+    '*.rpy',
+    '/lib/game/lib/*darwin-*',
+    '/lib/game/lib/*windows-*',
+    '/lib/game/lib/*-i686',
+)
+
+_GAME_SH_MODULE: typing.Mapping[str, typing.Any] = types.MappingProxyType({
+    'buildsystem': 'simple',
+    'name': 'game_sh',
+    'sources': (),
+    'build-commands': (
+        'mkdir -p /app/bin',
+        'echo  \'cd /app/lib/game/; export RENPY_PERFORMANCE_TEST=0; sh *.sh\' > /app/bin/game.sh',
+        'chmod +x /app/bin/game.sh'
+    ),
+})
+
+_BUILD_OPTIONS: typing.Mapping[str, typing.Any] = types.MappingProxyType({
+    'no-debuginfo': True,
+    'strip': False
+})
+
+_FINISH_ARGS: typing.Tuple[str, ...] = (
+    '--socket=pulseaudio',
+    '--socket=wayland',
+    # TODO: for projects with repny >= 7.4 it's possible to use wayland, and in that case
+    # We'd really like to do wayland and fallback-x11 (use wayland, but
+    # allow x11 as a fallback), and not enable wayland for < 7.4
+    # It's not clear yet to me how to test the renpy version from the
+    # script, which doesn't have access to the decompressesd sources
+    # See: https://github.com/renpy/renpy-build/issues/60
+    '--socket=x11',
+    '--device=dri',
+)
 
-    # TODO: typing requires more thought
-    modules: typing.List[typing.Dict[str, typing.Any]] = [
+
+def dump_json(args: Arguments, workdir: pathlib.Path, appid: str, desktop_file: pathlib.Path, appdata_file: pathlib.Path) -> None:
+    name = args.description['common']['name']
+    want_icon = args.description.get('workarounds', {}).get('icon', True)
+
+    # Hash everything up front, hashlib releases the GIL so the small files
+    # and patches can be done while the (much larger) archive is hashed
+    input_path = os.fspath(args.input)
+    desktop_path = os.fspath(desktop_file)
+    appdata_path = os.fspath(appdata_file)
+    patch_files = [os.path.abspath(pa) for pa, _ in args.patches or []]
+    to_hash = [input_path, desktop_path, appdata_path, *patch_files]
+    with concurrent.futures.ThreadPoolExecutor(min(len(to_hash), os.cpu_count() or 1)) as executor:
+        digests = dict(zip(to_hash, executor.map(sha256, to_hash)))
+    save_hash_cache()
+
+    sources: typing.List[typing.Dict[str, str]] = [
         {
-            'buildsystem': 'simple',
-            'name': sanitize_name(args.description['common']['name']),
-            'sources': [
-                {
-                    'path': args.input.as_posix(),
-                    'sha256':  sha256(args.input),
-                    'type': 'archive',
-                },
-            ],
-            'build-commands': [
-                'mkdir -p /app/lib/game',
+            'path': input_path,
+            'sha256': digests[input_path],
+            'type': 'archive',
+        },
+    ]
+    build_commands: typing.List[str] = list(_GAME_BUILD_COMMANDS)
 
-                # install the main game files
-                'mv *.sh *.py renpy game lib /app/lib/game/',
+    if args.patches:
+        sources.extend(
+            {'path': patch, 'sha256': digests[patch], 'type': 'file'}
+            for patch in patch_files)
+        build_commands.extend(
+            f'mv {os.path.basename(patch)} /app/lib/game/{d}'
+            for patch, (_, d) in zip(patch_files, args.patches))
 
-                # Patch the game to not require sandbox access
-                '''sed -i 's@"~/.renpy/"@os.environ.get("XDG_DATA_HOME", "~/.local/share") + "/"@g' /app/lib/game/*.py''',
+        # Recompile the game and all new rpy files
+        build_commands.append(_COMPILE_COMMAND)
 
-                'pushd /app/lib/game; ./*.sh . compile --keep-orphan-rpyc; popd',
-            ],
-            'cleanup': [
-                '*.exe',
-                '*.app',
-                '*.rpyc.bak',
-                '*.rpy',
-                '/lib/game/lib/*darwin-*',
-                '/lib/game/lib/*windows-*',
-                '/lib/game/lib/*-i686',
-            ],
-        },
+    # TODO: typing requires more thought
+    modules: typing.List[typing.Dict[str, typing.Any]] = [
         {
             'buildsystem': 'simple',
-            'name': 'game_sh',
-            'sources': [],
-            'build-commands': [
-                'mkdir -p /app/bin',
-                'echo  \'cd /app/lib/game/; export RENPY_PERFORMANCE_TEST=0; sh *.sh\' > /app/bin/game.sh',
-                'chmod +x /app/bin/game.sh'
-            ],
+            'name': sanitize_name(name),
+            'sources': sources,
+            'build-commands': build_commands,
+            'cleanup': _GAME_CLEANUP,
         },
+        dict(_GAME_SH_MODULE),
         {
             'buildsystem': 'simple',
             'name': 'desktop_file',
             'sources': [
                 {
-                    'path': desktop_file.as_posix(),
-                    'sha256': sha256(desktop_file),
+                    'path': desktop_path,
+                    'sha256': digests[desktop_path],
                     'type': 'file',
                 }
             ],
@@ -200,8 +390,8 @@ def dump_json(args: Arguments, workdir: pathlib.Path, appid: str, desktop_file:
             'name': 'appdata_file',
             'sources': [
                 {
-                    'path': appdata_file.as_posix(),
-                    'sha256': sha256(appdata_file),
+                    'path': appdata_path,
+                    'sha256': digests[appdata_path],
                     'type': 'file',
                 }
             ],
@@ -212,7 +402,7 @@ def dump_json(args: Arguments, workdir: pathlib.Path, appid: str, desktop_file:
         },
     ]
 
-    if args.description.get('workarounds', {}).get('icon', True):
+    if want_icon:
         icon_src = '/app/lib/game/game/gui/window_icon.png'
         icon_dst = f'/app/share/icons/hicolor/256x256/apps/{appid}.png'
         # Must at least be before the appdata is generated
@@ -234,55 +424,20 @@ def dump_json(args: Arguments, workdir: pathlib.Path, appid: str, desktop_file:
             ],
         })
 
-    sources: typing.List[typing.Dict[str, str]]
-    build_commands: typing.List[str]
-
-    if args.patches:
-        sources = []
-        build_commands = []
-        for pa, d in args.patches:
-            patch = pathlib.Path(pa).absolute()
-            sources.append({
-                'path': patch.as_posix(),
-                'sha256': sha256(patch),
-                'type': 'file'
-            })
-            build_commands.append(f'mv {patch.name} /app/lib/game/{d}')
-
-        # Recompile the game and all new rpy files
-        build_commands.append(
-            'pushd /app/lib/game; ./*.sh . compile --keep-orphan-rpyc; popd')
-
-        modules[0]['sources'].extend(sources)
-        modules[0]['build-commands'].extend(build_commands)
-
     struct = {
         'sdk': 'org.freedesktop.Sdk',
         'runtime': 'org.freedesktop.Platform',
         'runtime-version': '21.08',
         'app-id': appid,
-        'build-options': {
-            'no-debuginfo': True,
-            'strip': False
-        },
+        'build-options': dict(_BUILD_OPTIONS),
         'command': 'game.sh',
-        'finish-args': [
-            '--socket=pulseaudio',
-            '--socket=wayland',
-            # TODO: for projects with repny >= 7.4 it's possible to use wayland, and in that case
-            # We'd really like to do wayland and fallback-x11 (use wayland, but
-            # allow x11 as a fallback), and not enable wayland for < 7.4
-            # It's not clear yet to me how to test the renpy version from the
-            # script, which doesn't have access to the decompressesd sources
-            # See: https://github.com/renpy/renpy-build/issues/60
-            '--socket=x11',
-            '--device=dri',
-        ],
+        'finish-args': _FINISH_ARGS,
         'modules': modules,
     }
 
-    with (pathlib.Path(workdir) / f'{appid}.json').open('w') as f:
-        json.dump(struct, f)
+    # This is only read by flatpak-builder, so don't waste bytes on whitespace
+    (pathlib.Path(workdir) / f'{appid}.json').write_bytes(
+        json.dumps(struct, separators=(',', ':')).encode('utf-8'))
 
 
 def build_flatpak(args: Arguments, workdir: pathlib.Path, appid: str) -> None:
@@ -305,9 +460,9 @@ def load_description(name: str) -> Description:
 
 
 @contextlib.contextmanager
-def tmpdir(name: str, cleanup: bool = True) -> typing.Iterator[pathlib.Path]:
-    tdir = pathlib.Path(tempfile.gettempdir()) / name
-    tdir.mkdir(parents=True, exist_ok=True)
+def tmpdir(name: str, cleanup: bool = True) -> typing.Iterator[str]:
+    tdir = os.path.join(tempfile.gettempdir(), name)
+    os.makedirs(tdir, exist_ok=True)
     yield tdir
     if cleanup:
         shutil.rmtree(tdir)
@@ -327,9 +482,10 @@ def main() -> None:
     # Don't use type for this because it swallows up the exception
     args.description = load_description(args.description)  # type: ignore
 
-    appid = f"{args.description['common']['reverse_url']}.{sanitize_name(args.description['common']['name'])}"
+    common = args.description['common']
+    appid = f"{common['reverse_url']}.{sanitize_name(common['name'])}"
 
-    with tmpdir(args.description['common']['name'], args.cleanup) as d:
+    with tmpdir(common['name'], args.cleanup) as d:
         wd = pathlib.Path(d)
         desktop_file = create_desktop(args, wd, appid)
         appdata_file = create_appdata(args, wd, appid)